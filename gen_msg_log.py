@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import heapq
+import random
+import argparse
+
+import run_benchmark
+
+# Relative frequency of the message targets in a generated log. ACKs are not
+# part of the mix, they are generated according to the ACK ratio.
+DEFAULT_MIX = {
+    "ALERT": 1, "BYE": 1, "DATA": 40, "ERR": 1, "GAMECOMMAND": 5, "HI": 2,
+    "JOIN": 1, "LANG": 1, "LOG": 5, "MCONNECT": 1, "MDISCONNECT": 1,
+    "MLIST": 1, "MRECONNECT": 1, "PCONNECT": 2, "PDISCONNECT": 2,
+    "PLAYER_UPDATE": 10, "PLIST": 3, "PRECONNECT": 1, "REDIRECT": 1,
+    "SERVERCOMMAND": 2, "SETUP": 3, "STAGE": 8, "STAGE_LEVEL": 8, "TXT": 5,
+    "WARN": 1
+}
+
+
+def parse_mix(mix_str):
+    """ Parses a message mix of the form 'DATA=10,STAGE=2' into a dictionary
+    mapping targets to their relative frequencies. """
+    mix = {}
+    for item in mix_str.split(','):
+        target, weight = item.split('=')
+        mix[target.strip()] = float(weight)
+    return mix
+
+
+def format_line(time_ms, msg):
+    """ Returns the winston log line of `msg` logged at `time_ms`. """
+    return json.dumps({'level': 'info', 'message': 'msg',
+                       'GameMsg': msg,
+                       'timestamp': run_benchmark.iso_fmt(time_ms)}) + '\n'
+
+
+def generate_msg_log(out, num_lines, num_clients=100, mix=None,
+                     ack_ratio=0.0, retransmit_ratio=0.0, game='ultimatum',
+                     mean_interval=1.0, ack_delay=5.0, retry_timeout=4000,
+                     seed=0):
+    """ Writes a synthetic server message log of exactly `num_lines` lines
+    to the file object `out`, in the format parsed by
+    run_benchmark.parse_server_msg_file().
+
+    Messages are exchanged between `num_clients` clients and the server of
+    `game`, the targets are drawn according to `mix`. A fraction `ack_ratio`
+    of all messages is acknowledged by the receiver after an exponentially
+    distributed delay with mean `ack_delay` milliseconds, and a fraction
+    `retransmit_ratio` is sent again after `retry_timeout` milliseconds.
+    Subsequent messages are `mean_interval` milliseconds apart on average.
+    The output only depends on the arguments, including `seed`. """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    targets = list(mix)
+    weights = list(mix.values())
+    clients = ['{:016d}'.format(i) for i in range(num_clients)]
+
+    # the log starts at a fixed point in time to make the output reproducible
+    now = 1420070400000.0
+    msg_id = 0
+    # heap of (time, sequence number, message) to be logged later
+    scheduled = []
+    sequence = 0
+    lines = 0
+
+    while lines < num_lines:
+        now += rng.expovariate(1.0 / mean_interval)
+
+        # first log everything that became due in the meantime
+        while scheduled and scheduled[0][0] <= now and lines < num_lines:
+            time_ms, _, msg = heapq.heappop(scheduled)
+            out.write(format_line(time_ms, msg))
+            lines += 1
+        if lines == num_lines:
+            break
+
+        msg_id += 1
+        client = rng.choice(clients)
+        to_server = rng.random() < 0.5
+        msg = {
+            'id': msg_id,
+            'session': '1',
+            'stage': {'stage': 1, 'step': 1, 'round': 1},
+            'action': 'say',
+            'target': rng.choices(targets, weights)[0],
+            'from': client if to_server else game,
+            'to': 'SERVER' if to_server else client,
+            'text': None,
+            'data': {'value': rng.randint(0, 100)},
+            'priority': None,
+            'reliable': 1 if ack_ratio else 0,
+            'created': run_benchmark.iso_fmt(
+                now - (rng.random() if to_server else 0))
+        }
+        out.write(format_line(now, msg))
+        lines += 1
+
+        # a retransmitted message is acknowledged only after its last
+        # transmission
+        sent = now
+        if rng.random() < retransmit_ratio:
+            sent += retry_timeout
+            heapq.heappush(scheduled, (sent, sequence, msg))
+            sequence += 1
+
+        if rng.random() < ack_ratio:
+            msg_id += 1
+            # the server acknowledges messages in the name of the game
+            ack = dict(msg, id=msg_id, target='ACK', text=str(msg['id']),
+                       data=None, reliable=0,
+                       created=run_benchmark.iso_fmt(sent),
+                       to=client if to_server else 'SERVER')
+            ack['from'] = game if to_server else client
+            delay = rng.expovariate(1.0 / ack_delay)
+            heapq.heappush(scheduled, (sent + delay, sequence, ack))
+            sequence += 1
+
+
+def get_cmd_args():
+    # Define ArgumentParser and declare all needed command line arguments
+    parser = argparse.ArgumentParser(description='Generate a synthetic server '
+                                     'message log for testing and '
+                                     'benchmarking the analysis of '
+                                     'run_benchmark.py.')
+
+    parser.add_argument('-o', '--output', type=str, default='-',
+                        help='Output file, defaults to standard output.')
+
+    parser.add_argument('-l', '--lines', type=int, required=True,
+                        help='Number of lines of the generated log.')
+
+    parser.add_argument('-c', '--clients', type=int, default=100,
+                        help='Number of clients exchanging messages with '
+                        'the server.')
+
+    parser.add_argument('-m', '--mix', type=parse_mix,
+                        help='Relative frequency of message targets, e.g. '
+                        '"DATA=10,STAGE=2". Defaults to a mix resembling an '
+                        'ultimatum game.')
+
+    parser.add_argument('-a', '--ack_ratio', type=float, default=0.0,
+                        help='Fraction of messages which are acknowledged.')
+
+    parser.add_argument('-rt', '--retransmit_ratio', type=float, default=0.0,
+                        help='Fraction of messages which are retransmitted.')
+
+    parser.add_argument('-g', '--game', type=str, default='ultimatum',
+                        help='Name of the game sending server messages.')
+
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='Seed of the random number generator.')
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_cmd_args()
+
+    if args.output == '-':
+        out = sys.stdout
+    else:
+        out = open(args.output, 'w')
+
+    with out:
+        generate_msg_log(out, args.lines, args.clients, args.mix,
+                         args.ack_ratio, args.retransmit_ratio, args.game,
+                         seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
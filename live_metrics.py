@@ -0,0 +1,239 @@
+import os
+import json
+import bisect
+import datetime
+import threading
+import collections
+import http.server
+
+# Upper bounds in seconds of the buckets of the ACK latency histogram.
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0]
+
+# Maximal number of messages waiting for an ACK which are tracked. Older ones
+# are dropped, so that memory stays bounded if ACKs get lost.
+MAX_PENDING = 100000
+
+
+class LiveMetrics:
+    """ Thread-safe container of the current metrics of a benchmark run.
+    Updated by run_benchmark.get_process_metrics() and by a MsgLogTailer,
+    rendered in the Prometheus text exposition format by exposition(). """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, reliable=False, **labels):
+        """ Clears all metrics at the beginning of a new run. Messages are
+        only tracked until their ACK arrives if `reliable` messaging is
+        turned on. `labels` describe the run, e.g. num_conns=100. """
+        with self._lock:
+            self.reliable = reliable
+            self.labels = dict(labels, reliable=reliable)
+            self.process = {}
+            self.msg_counter = collections.Counter()
+            self.pending = collections.OrderedDict()
+            self.buckets = [0] * len(LATENCY_BUCKETS)
+            self.latency_sum = 0.0
+            self.latency_count = 0
+
+    def set_process(self, **values):
+        """ Updates the process metrics, e.g. cpu_user=1.5. """
+        with self._lock:
+            self.process.update(values)
+
+    def add_message(self, game_msg, timestamp, game):
+        """ Accounts for a message of the server message log. Reliable
+        messages sent by the server of `game` are tracked until the ACK of the
+        client arrives, the time in between is added to the latency
+        histogram. """
+        with self._lock:
+            self.msg_counter[game_msg['target']] += 1
+
+            if game_msg['target'] == 'ACK':
+                if game_msg['to'] != 'SERVER':
+                    return
+                sent = self.pending.pop(game_msg['text'], None)
+                if sent is None:
+                    return
+                latency = (timestamp() - sent).total_seconds()
+                index = bisect.bisect_left(LATENCY_BUCKETS, latency)
+                if index < len(self.buckets):
+                    self.buckets[index] += 1
+                self.latency_sum += latency
+                self.latency_count += 1
+
+            elif self.reliable and game_msg.get('reliable') and \
+                    game_msg['from'] == game:
+                self.pending[str(game_msg['id'])] = timestamp()
+                if len(self.pending) > MAX_PENDING:
+                    self.pending.popitem(last=False)
+
+    def exposition(self):
+        """ Returns all metrics in the Prometheus text exposition format. """
+        lines = []
+
+        def metric(name, kind, doc, samples):
+            lines.append('# HELP {} {}'.format(name, doc))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (labels, value) in samples:
+                label_str = ','.join('{}="{}"'.format(k, v)
+                                     for (k, v) in labels)
+                lines.append('{}{} {}'.format(
+                    name, '{' + label_str + '}' if label_str else '', value))
+
+        with self._lock:
+            metric('nodegame_run_info', 'gauge',
+                   'Parameters of the current benchmark run.',
+                   [(sorted(self.labels.items()), 1)])
+
+            process = self.process
+            if 'cpu_user' in process:
+                metric('nodegame_cpu_seconds_total', 'counter',
+                       'CPU time of the server and its children.',
+                       [([('mode', 'user')], process['cpu_user']),
+                        ([('mode', 'system')], process['cpu_system'])])
+            if 'mem_rss' in process:
+                metric('nodegame_memory_rss_bytes', 'gauge',
+                       'Resident set size of the server and its children.',
+                       [([], process['mem_rss'])])
+                metric('nodegame_memory_vms_bytes', 'gauge',
+                       'Virtual memory size of the server and its children.',
+                       [([], process['mem_vms'])])
+            if 'net_bytes_recv' in process:
+                metric('nodegame_network_bytes_total', 'counter',
+                       'Bytes moved over the network since the start of the '
+                       'run.',
+                       [([('direction', 'recv')], process['net_bytes_recv']),
+                        ([('direction', 'sent')], process['net_bytes_sent'])])
+            if 'established' in process:
+                metric('nodegame_established_connections', 'gauge',
+                       'Established connections on the listening ports of '
+                       'the server.', [([], process['established'])])
+
+            metric('nodegame_messages_total', 'counter',
+                   'Messages in the server message log by target.',
+                   [([('target', t)], c)
+                    for (t, c) in sorted(self.msg_counter.items())])
+            metric('nodegame_pending_reliable_messages', 'gauge',
+                   'Reliable server messages waiting for an ACK.',
+                   [([], len(self.pending))])
+
+            name = 'nodegame_ack_latency_seconds'
+            lines.append('# HELP {} Time between sending a reliable server '
+                         'message and receiving its ACK.'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            cumulative = 0
+            for (bound, count) in zip(LATENCY_BUCKETS, self.buckets):
+                cumulative += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound,
+                                                               cumulative))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(
+                         name, self.latency_count))
+            lines.append('{}_sum {}'.format(name, self.latency_sum))
+            lines.append('{}_count {}'.format(name, self.latency_count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MsgLogTailer(threading.Thread):
+    """ Background thread following the server message log while it is
+    written and feeding every new message to a LiveMetrics instance. The file
+    is polled every `interval` seconds, it does not need to exist yet when
+    the thread is started. """
+
+    def __init__(self, msg_file, live, game, interval=1.0):
+        super().__init__(daemon=True)
+        self.msg_file = msg_file
+        self.live = live
+        self.game = game
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """ Reads the remaining lines and terminates the thread. """
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        msg_fp = None
+        inode = None
+        partial = ''
+
+        while True:
+            stopping = self._stop_event.is_set()
+            try:
+                stat = os.stat(self.msg_file)
+                # the log is recreated for every run, follow the new file
+                if stat.st_ino != inode or (msg_fp and
+                                            stat.st_size < msg_fp.tell()):
+                    if msg_fp:
+                        msg_fp.close()
+                    msg_fp = open(self.msg_file)
+                    inode = stat.st_ino
+                    partial = ''
+            except OSError:
+                pass
+
+            if msg_fp:
+                lines = (partial + msg_fp.read()).split('\n')
+                # the last line might not be completely written yet
+                partial = lines.pop()
+                for line in lines:
+                    self._add_line(line)
+
+            if stopping:
+                break
+            self._stop_event.wait(self.interval)
+
+        if msg_fp:
+            msg_fp.close()
+
+    def _add_line(self, line):
+        try:
+            winston_msg = json.loads(line)
+            game_msg = winston_msg['GameMsg']
+        except (ValueError, KeyError, TypeError):
+            return
+
+        # timestamps are only parsed when needed for the latency histogram
+        def timestamp():
+            return datetime.datetime.strptime(winston_msg['timestamp'],
+                                              '%Y-%m-%dT%H:%M:%S.%fZ')
+
+        try:
+            self.live.add_message(game_msg, timestamp, self.game)
+        except (ValueError, KeyError):
+            pass
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves the metrics of the LiveMetrics instance of the server under
+    /metrics. """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.live.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # do not clutter the output of the benchmark with request logs
+        pass
+
+
+def start_server(live, port, host='127.0.0.1'):
+    """ Serves `live` on http://<host>:<port>/metrics from a background
+    thread. Returns the server, call its shutdown() method to stop it. """
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.live = live
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import datetime
+import argparse
+import platform
+import threading
+import itertools
+import collections
+
+import run_benchmark
+import results_store
+
+try:
+    import socketio
+except ImportError:
+    found_socketio = False
+else:
+    found_socketio = True
+
+# Seconds to wait for the HI message of the server after connecting.
+HI_TIMEOUT = 10.0
+
+
+def parse_iso(iso_str):
+    """ Parses JavaScript's Date.prototype.toISOString() into a datetime. """
+    return datetime.datetime.strptime(iso_str, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def load_sessions(msg_file, game):
+    """ Reads a recorded server message log and rebuilds the send sequence
+    of every client, including the messages addressed to other players.
+    Returns a dictionary mapping client ids to lists of (offset, message)
+    tuples, where offset is the time in seconds between the first message in
+    the log and the creation of the message by the client, and a counter of
+    the skipped messages. Messages sent by the server of `game` are skipped,
+    as well as the ACKs of the clients, which refer to server messages of the
+    recorded session. """
+    sessions = collections.defaultdict(list)
+    skipped = collections.Counter()
+    first = None
+
+    with open(msg_file) as messages:
+        for message in messages:
+            game_msg = json.loads(message)['GameMsg']
+            created = parse_iso(game_msg['created'])
+            if first is None or created < first:
+                first = created
+
+            if game_msg['from'] in (game, 'SERVER'):
+                skipped['server'] += 1
+            elif game_msg['target'] == 'ACK':
+                skipped['ack'] += 1
+            else:
+                sessions[game_msg['from']].append((created, game_msg))
+
+    for schedule in sessions.values():
+        schedule.sort(key=lambda item: item[0])
+        schedule[:] = [((created - first).total_seconds(), msg)
+                       for (created, msg) in schedule]
+
+    return sessions, skipped
+
+
+async def replay_client(url, namespace, client_id, schedule, players, start,
+                        speed, grace, reliable, stats):
+    """ Connects a single client to the server and sends the messages of
+    `schedule` with their original spacing divided by `speed`, relative to
+    the event loop time `start`. The recorded messages are sent with the
+    player id and session the server assigns in its HI message and with
+    fresh message ids, so that copies of a client do not collide. `players`
+    maps the recorded client ids of the same copy to their assigned player
+    ids, the recorded recipients of messages to other players are replaced
+    with them. Reliable messages of the server are acknowledged. If the
+    server uses `reliable` messaging, waits up to `grace` seconds for
+    outstanding ACKs before disconnecting. """
+    loop = asyncio.get_running_loop()
+    sio = socketio.AsyncClient(reconnection=False)
+    # message id -> send time of the messages waiting for an ACK
+    pending = {}
+    player = {}
+    welcomed = asyncio.Event()
+    # set once the namespace is connected and the HI message arrived,
+    # reliable server messages received before are acknowledged afterwards
+    ready = asyncio.Event()
+    unacked = []
+    msg_ids = itertools.count(random.randrange(10**9))
+
+    async def send(msg):
+        msg = dict(msg, id=next(msg_ids), session=player['session'],
+                   created=run_benchmark.iso_fmt(time.time() * 1000))
+        msg['from'] = player['id']
+        if isinstance(msg['to'], list):
+            msg['to'] = [players.get(to, to) for to in msg['to']]
+        else:
+            msg['to'] = players.get(msg['to'], msg['to'])
+        await sio.send(json.dumps(msg), namespace=namespace)
+        return msg
+
+    async def acknowledge(msg):
+        await send({'target': 'ACK', 'action': 'say', 'to': 'SERVER',
+                    'text': str(msg.get('id')), 'data': None,
+                    'stage': msg.get('stage'), 'reliable': 0})
+        stats['acks_sent'] += 1
+
+    async def on_message(data):
+        msg = json.loads(data) if isinstance(data, str) else data
+        stats['received'] += 1
+
+        if msg.get('target') == 'HI' and not welcomed.is_set():
+            data = msg.get('data')
+            player['id'] = data.get('id') if isinstance(data, dict) \
+                else msg.get('to')
+            player['session'] = msg.get('session')
+            players[client_id] = player['id']
+            welcomed.set()
+        elif msg.get('target') == 'ACK':
+            if msg.get('text') in pending:
+                stats['latencies'].append(
+                    loop.time() - pending.pop(msg['text']))
+            return
+
+        # acknowledge reliable messages, otherwise the server keeps
+        # retransmitting them
+        if msg.get('reliable'):
+            if ready.is_set():
+                await acknowledge(msg)
+            else:
+                unacked.append(msg)
+
+    sio.on('message', on_message, namespace=namespace)
+    await sio.connect(url, namespaces=[namespace], transports=['websocket'])
+    # also disconnect if the server does not say HI or sending fails, the
+    # connection would count as established otherwise
+    try:
+        await asyncio.wait_for(welcomed.wait(), HI_TIMEOUT)
+        stats['connected'] += 1
+
+        ready.set()
+        for msg in unacked:
+            await acknowledge(msg)
+
+        for (offset, msg) in schedule:
+            delay = start + offset / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                stats['max_lag'] = max(stats['max_lag'], -delay)
+
+            msg = await send(msg)
+            if reliable:
+                pending[str(msg['id'])] = loop.time()
+            stats['sent'] += 1
+
+        deadline = loop.time() + grace
+        while pending and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+    finally:
+        await sio.disconnect()
+
+
+async def replay(sessions, url, namespace, speed, copies, jitter, grace,
+                 reliable, stats):
+    """ Replays all sessions `copies` times concurrently. Every copy starts
+    after a random delay of up to `jitter` seconds, so that the copies do not
+    send their messages in lockstep, and only exchanges messages among its
+    own clients. """
+    loop = asyncio.get_running_loop()
+    clients = []
+    for _ in range(copies):
+        # give all clients some time to connect before the first message is
+        # due
+        start = loop.time() + 1.0 + random.uniform(0, jitter)
+        players = {}
+        clients += [replay_client(url, namespace, client_id, schedule,
+                                  players, start, speed, grace, reliable,
+                                  stats)
+                    for (client_id, schedule) in sessions.items()]
+
+    results = await asyncio.gather(*clients, return_exceptions=True)
+    stats['errors'] = [r for r in results if isinstance(r, Exception)]
+
+
+def get_cpu_times(pid):
+    """ Returns the user and system CPU times of the process `pid` and all its
+    children. """
+    p = run_benchmark.psutil.Process(pid)
+    cpu = list(p.cpu_times())[:2]
+    for child in p.children(recursive=True):
+        c_cpu = child.cpu_times()
+        cpu[0] += c_cpu[0]
+        cpu[1] += c_cpu[1]
+
+    return cpu
+
+
+class ReplayRun:
+    """ Runs a replay in a background thread. Mimics the part of the Popen
+    interface used by run_benchmark.get_process_metrics(), with `pid` being
+    the pid of the server receiving the traffic, so that the server can be
+    monitored while the replay is running. """
+
+    def __init__(self, server_pid, *replay_args):
+        self.pid = server_pid
+        self.returncode = None
+        self._thread = threading.Thread(target=self._run, args=replay_args)
+        self._thread.start()
+
+    def _run(self, *replay_args):
+        stats = replay_args[-1]
+        try:
+            asyncio.run(replay(*replay_args))
+        except Exception as err:
+            stats['errors'].append(err)
+        self.returncode = 1 if stats['errors'] else 0
+
+    def poll(self):
+        return None if self._thread.is_alive() else self.returncode
+
+    def wait(self):
+        self._thread.join()
+        return self.returncode
+
+
+def get_cmd_args():
+    # Define ArgumentParser and declare all needed command line arguments
+    parser = argparse.ArgumentParser(description='Replay the client messages '
+                                     'of a recorded server message log '
+                                     'against a running nodegame server.')
+
+    parser.add_argument('msg_file', type=str,
+                        help='Recorded server message log to replay.')
+
+    parser.add_argument('-u', '--url', type=str,
+                        default='http://localhost:8080',
+                        help='Url of the running nodegame server.')
+
+    parser.add_argument('-ns', '--namespace', type=str,
+                        help='Socket.io namespace of the game channel, '
+                        'defaults to /<game>.')
+
+    parser.add_argument('-g', '--game', type=str, default='ultimatum',
+                        help='Name of the game whose server messages are '
+                        'skipped when reading the recorded log.')
+
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='Speed factor, e.g. 2 replays the traffic twice '
+                        'as fast as recorded.')
+
+    parser.add_argument('-n', '--copies', type=int, default=1,
+                        help='Number of copies of the recorded client '
+                        'population to replay concurrently.')
+
+    parser.add_argument('-j', '--jitter', type=float, default=1.0,
+                        help='Maximal random delay in seconds of the start '
+                        'of every copy, so that the copies do not send their '
+                        'messages at the same time.')
+
+    parser.add_argument('-gr', '--grace', type=float, default=5.0,
+                        help='Seconds to wait for outstanding ACKs after the '
+                        'last message of a client when reliable messaging is '
+                        'used.')
+
+    parser.add_argument('-p', '--server_pid', type=int,
+                        help='Pid of the server to record CPU, memory and '
+                        'network metrics of.')
+
+    parser.add_argument('-m', '--server_msg_file', type=str,
+                        help='Message log the server writes during the '
+                        'replay, analyzed like in a normal run. Only the '
+                        'messages appended during the replay are counted.')
+
+    parser.add_argument('-r', '--reliable', action='store_true',
+                        help='Boolean flag indicating that the server uses '
+                        'reliable messaging, enables measuring the ACK '
+                        'latency.')
+
+    parser.add_argument('-d', '--db', type=str,
+                        help='SQLite results store to add the run to.')
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_cmd_args()
+
+    if not found_socketio:
+        print("Error: Was not able to import socketio. Please install it via "
+              "`pip3 install python-socketio aiohttp`.",
+              file=sys.stderr)
+        sys.exit(1)
+
+    if args.server_pid and not run_benchmark.found_psutil:
+        print("Warning: psutil is not installed, the server will not be "
+              "monitored.", file=sys.stderr)
+
+    sessions, skipped = load_sessions(args.msg_file, args.game)
+    num_clients = len(sessions) * args.copies
+    num_msgs = sum(len(s) for s in sessions.values()) * args.copies
+    print("Replaying {} messages of {} clients at {}x speed".format(
+          num_msgs, num_clients, args.speed))
+    print("Skipped {} recorded server messages and {} recorded ACKs".format(
+          skipped['server'], skipped['ack']))
+
+    stats = {'connected': 0, 'sent': 0, 'received': 0, 'acks_sent': 0,
+             'max_lag': 0.0, 'latencies': [], 'errors': []}
+    namespace = args.namespace or '/' + args.game
+
+    monitor = args.server_pid and run_benchmark.found_psutil
+    # the server is already running, only account for the CPU time it spends
+    # and the messages it logs during the replay
+    if monitor:
+        psutil = run_benchmark.psutil
+        try:
+            cpu_start = get_cpu_times(args.server_pid)
+        except (psutil.NoSuchProcess, psutil.AccessDenied) as err:
+            print("Error: Could not monitor the server with --server_pid {}: "
+                  "{}".format(args.server_pid, err), file=sys.stderr)
+            sys.exit(1)
+    msg_offset = 0
+    if args.server_msg_file and os.path.exists(args.server_msg_file):
+        msg_offset = os.path.getsize(args.server_msg_file)
+
+    run_timestamp = int(time.time() * 10**6)
+    start = time.perf_counter()
+    run = ReplayRun(args.server_pid, sessions, args.url, namespace,
+                    args.speed, args.copies, args.jitter, args.grace,
+                    args.reliable, stats)
+
+    if monitor:
+        ret_replay, cpu_end, mem, net = \
+            run_benchmark.get_process_metrics(run)
+        # the server keeps running, so it can be sampled once more, else the
+        # last sample taken during the replay is used
+        try:
+            cpu_end = get_cpu_times(args.server_pid)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            print("Warning: The server exited during the replay.",
+                  file=sys.stderr)
+        cpu = [cpu_end[0] - cpu_start[0], cpu_end[1] - cpu_start[1]]
+    else:
+        ret_replay = run.wait()
+    duration = time.perf_counter() - start
+
+    for error in stats['errors']:
+        print("Warning: A client failed: {}".format(error), file=sys.stderr)
+
+    latencies = stats['latencies']
+    avg_latency = sum(latencies) / len(latencies) if latencies else None
+    print("Connected clients: {}/{}".format(stats['connected'], num_clients))
+    print("Sent {} and received {} messages in {}, {:.1f} messages/s".format(
+          stats['sent'], stats['received'], run_benchmark.time_fmt(duration),
+          stats['sent'] / duration))
+    print("Acknowledged {} reliable server messages".format(
+          stats['acks_sent']))
+    print("Maximal send lag: {}".format(
+          run_benchmark.time_fmt(stats['max_lag'])))
+    if avg_latency is not None:
+        print("Average ACK latency: {}".format(
+              run_benchmark.time_fmt(avg_latency)))
+
+    # collect the metrics of a normal run, as far as they are available
+    run_metrics = {
+        'id': run_timestamp,
+        'benchmark_id': run_benchmark.BENCHMARK_TIME,
+        'machine': platform.platform(),
+        'num_conns': num_clients,
+        'is_reliable': args.reliable,
+        'benchmark_ret_code': ret_replay,
+        'duration': duration
+    }
+    msg_counter = None
+
+    if args.server_msg_file:
+        if args.reliable:
+            msg_counter, avg_client_time, avg_server_time = \
+                run_benchmark.parse_server_msg_file(args.server_msg_file,
+                                                    args.reliable, msg_offset)
+            run_metrics['avg_client_time'] = avg_client_time
+            run_metrics['avg_server_time'] = avg_server_time
+        else:
+            msg_counter = run_benchmark.parse_server_msg_file(
+                args.server_msg_file, args.reliable, msg_offset)
+
+    if monitor:
+        run_metrics.update({
+            'cpu_time_user': cpu[0],
+            'cpu_time_system': cpu[1],
+            'mem_info_rss': mem[0],
+            'mem_info_vms': mem[1],
+            'net_bytes_recv': net['bytes_recv'],
+            'net_bytes_sent': net['bytes_sent'],
+            'net_packets_recv': net['packets_recv'],
+            'net_packets_sent': net['packets_sent'],
+            'net_bytes_per_client': net['traffic'] / num_clients,
+            'max_established_conns': net['max_established'],
+            'conn_churn': net['churn']
+        })
+        if msg_counter and msg_counter['total']:
+            run_metrics['net_bytes_per_msg'] = \
+                net['traffic'] / msg_counter['total']
+        print("CPU time: {} user, {} system, RSS: {}".format(
+              run_benchmark.time_fmt(cpu[0]), run_benchmark.time_fmt(cpu[1]),
+              run_benchmark.sizeof_fmt(mem[0])))
+
+    if args.db:
+        store = results_store.open_store(args.db)
+        results_store.insert_run(store, run_metrics, msg_counter)
+        print("Run {} added to {}".format(run_timestamp, args.db))
+
+    if ret_replay:
+        sys.exit(ret_replay)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+
+import re
+import os
+import sys
+import csv
+import glob
+import html
+import math
+import argparse
+import datetime
+import collections
+
+import results_store
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+except ImportError:
+    found_matplotlib = False
+else:
+    found_matplotlib = True
+
+# Metrics fitted against num_conns: (key, title, unit). The keys are columns
+# of metrics.csv or derived in derive_metrics().
+RESOURCE_METRICS = [
+    ("cpu_time", "CPU time (user + system)", "s"),
+    ("mem_info_rss", "Resident set size", "B"),
+    ("net_bytes", "Network traffic (received + sent)", "B"),
+    ("msg_total", "Messages", "msgs")
+]
+
+THROUGHPUT_METRIC = ("throughput", "Throughput", "msgs/s")
+
+
+def load_csv_runs(paths):
+    """ Reads metrics csv files written by run_benchmark.py, or all of them
+    in the given directories, into dictionaries of raw values. The total
+    number of messages is read from the corresponding messages csv file. """
+    metrics_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            metrics_files += sorted(glob.glob(
+                os.path.join(path, 'benchmark_*_metrics.csv')))
+        else:
+            metrics_files.append(path)
+
+    runs = []
+    for metrics_file in metrics_files:
+        msg_totals = {}
+        msg_file = metrics_file[:-len('metrics.csv')] + 'messages.csv'
+        if os.path.exists(msg_file):
+            with open(msg_file) as csv_msg:
+                for row in csv.DictReader(csv_msg):
+                    msg_totals[row['id']] = results_store.parse_value(
+                        row.get('total'))
+
+        with open(metrics_file) as csv_metrics:
+            for row in csv.DictReader(csv_metrics):
+                run = {k: results_store.parse_value(v)
+                       for (k, v) in row.items() if k != 'machine'}
+                run['machine'] = row.get('machine')
+                run['msg_total'] = msg_totals.get(row['id'])
+                runs.append(run)
+
+    return runs
+
+
+def load_db_runs(db_file, benchmark_ids):
+    """ Reads the runs of the given benchmarks from the results store. """
+    conn = results_store.open_store(db_file)
+    conn.row_factory = lambda cursor, row: {
+        col[0]: value for (col, value) in zip(cursor.description, row)}
+
+    sql = ("SELECT runs.*, messages.count AS msg_total FROM runs "
+           "LEFT JOIN messages ON messages.run_id = runs.id "
+           "AND messages.target = 'total'")
+    if benchmark_ids:
+        sql += " WHERE runs.benchmark_id IN ({})".format(
+               ", ".join("?" * len(benchmark_ids)))
+    return conn.execute(sql, benchmark_ids or []).fetchall()
+
+
+def derive_metrics(run):
+    """ Adds the metrics which are computed from the recorded ones. """
+    def total(*keys):
+        values = [run.get(k) for k in keys]
+        return None if None in values else sum(values)
+
+    run['cpu_time'] = total('cpu_time_user', 'cpu_time_system')
+    run['net_bytes'] = total('net_bytes_recv', 'net_bytes_sent')
+    if run.get('msg_total') and run.get('duration'):
+        run['throughput'] = run['msg_total'] / run['duration']
+    else:
+        run['throughput'] = None
+
+
+def group_series(runs):
+    """ Groups runs into series of equal machine, server build and reliable
+    messaging settings, which are named after the settings and, if the runs
+    differ in them, the build and the machine. Within a series the values of
+    runs with the same num_conns are averaged. Returns a dictionary mapping
+    series names to dictionaries mapping metric keys to sorted lists of
+    (num_conns, value) tuples. """
+    runs = [run for run in runs if run.get('num_conns')]
+    machines = {run.get('machine') for run in runs}
+    builds = {run.get('server_git_hash') for run in runs}
+
+    cells = collections.defaultdict(lambda: collections.defaultdict(list))
+    for run in runs:
+        if run.get('is_reliable'):
+            name = 'reliable, timeout {:.0f}'.format(run.get('timeout') or 0)
+        else:
+            name = 'unreliable'
+        if len(builds) > 1:
+            name += ', build {}'.format(
+                (run.get('server_git_hash') or 'unknown')[:8])
+        if len(machines) > 1:
+            name += ', {}'.format(run.get('machine') or 'unknown machine')
+        metrics = RESOURCE_METRICS + [THROUGHPUT_METRIC]
+        for (key, _, _) in metrics:
+            if run.get(key) is not None:
+                cells[(name, key)][run['num_conns']].append(run[key])
+
+    series = collections.defaultdict(dict)
+    for ((name, key), values) in cells.items():
+        series[name][key] = sorted((n, sum(v) / len(v))
+                                   for (n, v) in values.items())
+    return series
+
+
+def r_squared(ys, predicted):
+    """ Coefficient of determination of a fit. """
+    mean = sum(ys) / len(ys)
+    ss_tot = sum((y - mean) ** 2 for y in ys)
+    ss_res = sum((y - p) ** 2 for (y, p) in zip(ys, predicted))
+    return 1 - ss_res / ss_tot if ss_tot else float('nan')
+
+
+def fit_linear(xs, ys):
+    """ Least squares fit of y = a + b * x. Returns (a, b, r2), where b is
+    the cost per additional connection. """
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    var = sum((x - x_mean) ** 2 for x in xs)
+    b = sum((x - x_mean) * (y - y_mean) for (x, y) in zip(xs, ys)) / var
+    a = y_mean - b * x_mean
+    return a, b, r_squared(ys, [a + b * x for x in xs])
+
+
+def fit_power(xs, ys):
+    """ Least squares fit of log(y) = log(c) + k * log(x). Returns (c, k, r2)
+    or None if not all values are positive. An exponent k > 1 indicates a
+    superlinear growth. """
+    if min(ys) <= 0:
+        return None
+    log_c, k, _ = fit_linear([math.log(x) for x in xs],
+                             [math.log(y) for y in ys])
+    c = math.exp(log_c)
+    return c, k, r_squared(ys, [c * x ** k for x in xs])
+
+
+def usl(n, lam, sigma, kappa):
+    """ Universal Scalability Law: throughput with n connections given the
+    throughput of a single one, contention sigma and coherency kappa. """
+    return lam * n / (1 + sigma * (n - 1) + kappa * n * (n - 1))
+
+
+def fit_usl(ns, xs):
+    """ Least squares fit of the Universal Scalability Law. For given sigma
+    and kappa the optimal lambda has a closed form, so only sigma and kappa
+    are searched, first on a grid and then by a shrinking local search.
+    Returns (lam, sigma, kappa, r2). """
+    def best_lambda(sigma, kappa):
+        fs = [usl(n, 1.0, sigma, kappa) for n in ns]
+        lam = sum(x * f for (x, f) in zip(xs, fs)) / sum(f * f for f in fs)
+        error = sum((x - lam * f) ** 2 for (x, f) in zip(xs, fs))
+        return error, lam
+
+    grid = [0.0] + [10 ** (e / 4.0) for e in range(-32, 1)]
+    best = min((best_lambda(s, k) + (s, k) for s in grid for k in grid))
+    error, lam, sigma, kappa = best
+
+    step_sigma = max(sigma, 1e-6)
+    step_kappa = max(kappa, 1e-8)
+    while step_sigma > 1e-9 or step_kappa > 1e-11:
+        improved = False
+        for (ds, dk) in [(step_sigma, 0), (-step_sigma, 0), (0, step_kappa),
+                         (0, -step_kappa)]:
+            s, k = max(sigma + ds, 0.0), max(kappa + dk, 0.0)
+            candidate = best_lambda(s, k)
+            if candidate[0] < error:
+                (error, lam), sigma, kappa = candidate, s, k
+                improved = True
+                break
+        if not improved:
+            step_sigma /= 2
+            step_kappa /= 2
+
+    return lam, sigma, kappa, r_squared(
+        xs, [usl(n, lam, sigma, kappa) for n in ns])
+
+
+def usl_peak(sigma, kappa):
+    """ Number of connections with maximal throughput according to the
+    Universal Scalability Law, None if throughput grows without bound. """
+    if kappa <= 0:
+        return None
+    return math.sqrt((1 - sigma) / kappa) if sigma < 1 else 1.0
+
+
+def find_knee(ns, ys, tolerance):
+    """ Returns the number of connections after which the cost per connection
+    starts to climb, i.e. the last point before the cost per connection
+    exceeds its minimum so far by more than `tolerance`. None if the cost per
+    connection never climbs. Leading points without any cost, e.g. CPU times
+    below the resolution of the measurement, are skipped. """
+    best_cost = None
+    for i in range(len(ns)):
+        cost = ys[i] / ns[i]
+        if cost <= 0:
+            continue
+        if best_cost is not None and cost > (1 + tolerance) * best_cost:
+            return ns[i - 1]
+        best_cost = cost if best_cost is None else min(best_cost, cost)
+    return None
+
+
+def analyze(series, tolerance):
+    """ Fits all models to all metrics of all series. Returns a dictionary
+    mapping (series, metric key) to a dictionary of results. """
+    fits = {}
+    for (name, metrics) in series.items():
+        for (key, points) in metrics.items():
+            if len(points) < 2:
+                continue
+            ns = [n for (n, _) in points]
+            ys = [y for (_, y) in points]
+            fit = {'ns': ns, 'ys': ys, 'linear': fit_linear(ns, ys),
+                   'power': fit_power(ns, ys)}
+            if key == THROUGHPUT_METRIC[0]:
+                fit['usl'] = fit_usl(ns, ys)
+            else:
+                fit['knee'] = find_knee(ns, ys, tolerance)
+            fits[(name, key)] = fit
+    return fits
+
+
+def bottleneck(fits, name):
+    """ Returns the resource metric of series `name` which gives out first:
+    the one with the lowest knee or, without any knee, the one with the
+    largest scaling exponent. """
+    candidates = []
+    for (key, title, _) in RESOURCE_METRICS:
+        fit = fits.get((name, key))
+        if not fit or key == 'msg_total':
+            continue
+        knee = fit['knee'] if fit['knee'] is not None else float('inf')
+        exponent = fit['power'][1] if fit['power'] else 0.0
+        candidates.append((knee, -exponent, title))
+    return min(candidates)[2] if candidates else None
+
+
+def fmt_value(value, unit):
+    """ Formats a value with its unit for the report. """
+    if value is None:
+        return 'NA'
+    if unit == 'B':
+        for prefix in ['', 'Ki', 'Mi', 'Gi', 'Ti']:
+            if abs(value) < 1024.0:
+                return '{:.1f}{}B'.format(value, prefix)
+            value /= 1024.0
+        return '{:.1f}PiB'.format(value)
+    return '{:.4g} {}'.format(value, unit)
+
+
+def svg_chart(title, unit, ns, ys, curves, width=560, height=320):
+    """ Returns an inline SVG scatter plot of the measured points with the
+    fitted `curves`, a list of (label, function, color) tuples. """
+    margin = 60
+    x_max = max(ns) * 1.05
+    samples = [x_max * i / 100.0 for i in range(1, 101)]
+    curve_points = [[(x, f(x)) for x in samples] for (_, f, _) in curves]
+    y_max = max(ys + [y for points in curve_points for (_, y) in points
+                      if y <= 2 * max(ys)]) * 1.05 or 1.0
+
+    def px(x, y):
+        return (margin + x / x_max * (width - 1.5 * margin),
+                height - margin + 20 - y / y_max * (height - 1.5 * margin))
+
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" '
+             'font-family="sans-serif" font-size="11">'.format(width, height),
+             '<text x="{}" y="16" font-size="13">{}</text>'.format(
+                 margin, html.escape(title))]
+
+    x0, y0 = px(0, 0)
+    x1, y1 = px(x_max, y_max)
+    parts.append('<path d="M{:.1f} {:.1f} H{:.1f} M{:.1f} {:.1f} V{:.1f}" '
+                 'stroke="black" fill="none"/>'.format(x0, y0, x1, x0, y0, y1))
+    for i in range(6):
+        x, _ = px(x_max * i / 5, 0)
+        _, y = px(0, y_max * i / 5)
+        parts.append('<text x="{:.1f}" y="{:.1f}" text-anchor="middle">'
+                     '{:.0f}</text>'.format(x, y0 + 14, x_max * i / 5))
+        parts.append('<text x="{:.1f}" y="{:.1f}" text-anchor="end">{}'
+                     '</text>'.format(x0 - 4, y + 4,
+                                      fmt_value(y_max * i / 5, unit)))
+    parts.append('<text x="{:.1f}" y="{}" text-anchor="middle">num_conns'
+                 '</text>'.format((x0 + x1) / 2, height - 8))
+
+    for ((label, _, color), points) in zip(curves, curve_points):
+        coords = ' '.join('{:.1f},{:.1f}'.format(*px(x, y))
+                          for (x, y) in points if 0 <= y <= y_max)
+        parts.append('<polyline points="{}" stroke="{}" fill="none"/>'.format(
+                     coords, color))
+    for (n, y) in zip(ns, ys):
+        parts.append('<circle cx="{:.1f}" cy="{:.1f}" r="3"/>'.format(
+                     *px(n, y)))
+
+    for (i, (label, _, color)) in enumerate(curves):
+        parts.append('<text x="{}" y="{}" fill="{}">{}</text>'.format(
+                     width - 200, 34 + 14 * i, color, html.escape(label)))
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+def get_curves(fit):
+    """ Returns the fitted curves of `fit` as (label, function, color). """
+    a, b, _ = fit['linear']
+    curves = [('linear', lambda x: a + b * x, 'steelblue')]
+    if fit['power']:
+        c, k, _ = fit['power']
+        curves.append(('power, k = {:.2f}'.format(k),
+                       lambda x: c * x ** k, 'darkorange'))
+    if 'usl' in fit:
+        lam, sigma, kappa, _ = fit['usl']
+        curves.append(('USL', lambda x: usl(x, lam, sigma, kappa),
+                       'forestgreen'))
+    return curves
+
+
+def write_html(out_file, fits, series, sources):
+    """ Writes the self-contained HTML report. """
+    metrics = RESOURCE_METRICS + [THROUGHPUT_METRIC]
+    body = ['<h1>nodegame-benchmark scaling report</h1>',
+            '<p>Generated {} from {}.</p>'.format(
+                datetime.datetime.now().strftime('%Y-%m-%d %H:%M'),
+                html.escape(', '.join(sources)))]
+
+    for name in sorted(series):
+        body.append('<h2>{}</h2>'.format(html.escape(name)))
+        limit = bottleneck(fits, name)
+        if limit:
+            body.append('<p>Resource giving out first: <b>{}</b></p>'.format(
+                        html.escape(limit)))
+
+        body.append('<table><tr><th>Metric</th><th>Cost per connection</th>'
+                    '<th>R&sup2; linear</th><th>Exponent</th>'
+                    '<th>R&sup2; power</th><th>Knee</th></tr>')
+        for (key, title, unit) in metrics:
+            fit = fits.get((name, key))
+            if not fit or key == THROUGHPUT_METRIC[0]:
+                continue
+            power = fit['power']
+            body.append('<tr><td>{}</td><td>{}</td><td>{:.3f}</td><td>{}</td>'
+                        '<td>{}</td><td>{}</td></tr>'.format(
+                            title, fmt_value(fit['linear'][1], unit),
+                            fit['linear'][2],
+                            '{:.2f}'.format(power[1]) if power else 'NA',
+                            '{:.3f}'.format(power[2]) if power else 'NA',
+                            fit['knee'] if fit['knee'] is not None else '-'))
+        body.append('</table>')
+
+        fit = fits.get((name, THROUGHPUT_METRIC[0]))
+        if fit:
+            lam, sigma, kappa, r2 = fit['usl']
+            peak = usl_peak(sigma, kappa)
+            body.append(
+                '<p>Universal Scalability Law: &lambda; = {:.4g} msgs/s, '
+                '&sigma; = {:.4g}, &kappa; = {:.4g}, R&sup2; = {:.3f}. {}</p>'
+                .format(lam, sigma, kappa, r2,
+                        'Peak throughput of {:.4g} msgs/s at {:.0f} '
+                        'connections.'.format(usl(peak, lam, sigma, kappa),
+                                              peak)
+                        if peak else 'No throughput peak predicted.'))
+
+        for (key, title, unit) in metrics:
+            fit = fits.get((name, key))
+            if fit:
+                body.append(svg_chart(title, unit, fit['ns'], fit['ys'],
+                                      get_curves(fit)))
+
+    with open(out_file, 'w') as html_fp:
+        html_fp.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                      '<title>Scaling report</title><style>'
+                      'body {{font-family: sans-serif; margin: 2em}} '
+                      'td, th {{padding: 2px 10px; text-align: right}} '
+                      'svg {{margin: 1em 1em 0 0}}'
+                      '</style></head><body>\n{}\n</body></html>\n'
+                      .format('\n'.join(body)))
+
+
+def write_pngs(png_dir, fits):
+    """ Writes one PNG chart per series and metric using matplotlib. """
+    os.makedirs(png_dir, exist_ok=True)
+    titles = {key: title for (key, title, _) in
+              RESOURCE_METRICS + [THROUGHPUT_METRIC]}
+    for ((name, key), fit) in sorted(fits.items()):
+        fig, ax = plt.subplots()
+        ax.plot(fit['ns'], fit['ys'], 'ko', label='measured')
+        xs = [max(fit['ns']) * 1.05 * i / 100.0 for i in range(1, 101)]
+        for (label, func, color) in get_curves(fit):
+            ax.plot(xs, [func(x) for x in xs], color=color, label=label)
+        ax.set_title('{} ({})'.format(titles[key], name))
+        ax.set_xlabel('num_conns')
+        ax.legend()
+        fig.savefig(os.path.join(png_dir, '{}_{}.png'.format(
+                    re.sub(r'[^\w.-]+', '_', name), key)))
+        plt.close(fig)
+
+
+def get_cmd_args():
+    # Define ArgumentParser and declare all needed command line arguments
+    parser = argparse.ArgumentParser(description='Fit scaling models to '
+                                     'benchmark results and write an HTML '
+                                     'report.')
+
+    parser.add_argument('csv_files', type=str, nargs='*',
+                        help='Metrics csv files or directories containing '
+                        'them.')
+
+    parser.add_argument('-d', '--db', type=str,
+                        help='SQLite results store to read runs from.')
+
+    parser.add_argument('-b', '--benchmark_ids', type=int, nargs='+',
+                        help='Only consider these benchmarks of the results '
+                        'store, can be a list.')
+
+    parser.add_argument('-o', '--output', type=str, default='report.html',
+                        help='HTML file the report is written to.')
+
+    parser.add_argument('--png_dir', type=str,
+                        help='Folder to additionally write PNG charts to. '
+                        'Requires matplotlib.')
+
+    parser.add_argument('-k', '--knee_tolerance', type=float, default=0.1,
+                        help='Relative increase of the cost per connection '
+                        'that marks the knee.')
+
+    args = parser.parse_args()
+
+    if not args.csv_files and not args.db:
+        print('Error: Either csv files or --db need to be specified.',
+              file=sys.stderr)
+        sys.exit(1)
+
+    if args.png_dir and not found_matplotlib:
+        print('Error: Was not able to import matplotlib, which is needed for '
+              '--png_dir. Please install it via `pip3 install matplotlib`.',
+              file=sys.stderr)
+        sys.exit(1)
+
+    return args
+
+
+def main():
+    args = get_cmd_args()
+
+    runs = load_csv_runs(args.csv_files)
+    sources = list(args.csv_files)
+    if args.db:
+        runs += load_db_runs(args.db, args.benchmark_ids)
+        sources.append(args.db)
+
+    for run in runs:
+        derive_metrics(run)
+
+    series = group_series(runs)
+    fits = analyze(series, args.knee_tolerance)
+    if not fits:
+        print('Error: At least two different numbers of connections are '
+              'needed to fit scaling models.', file=sys.stderr)
+        sys.exit(1)
+
+    for name in sorted(series):
+        print(name)
+        for (key, title, unit) in RESOURCE_METRICS:
+            fit = fits.get((name, key))
+            if fit:
+                print('  {}: {} per connection, exponent {}, knee {}'.format(
+                      title, fmt_value(fit['linear'][1], unit),
+                      '{:.2f}'.format(fit['power'][1])
+                      if fit['power'] else 'NA',
+                      fit['knee'] if fit['knee'] is not None else '-'))
+        limit = bottleneck(fits, name)
+        if limit:
+            print('  Resource giving out first: {}'.format(limit))
+
+    write_html(args.output, fits, series, sources)
+    print('Report:\n{}'.format(args.output))
+
+    if args.png_dir:
+        write_pngs(args.png_dir, fits)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import re
+import os
+import sys
+import csv
+import glob
+import sqlite3
+import argparse
+
+# Columns of the runs table holding the metrics of a single benchmark run.
+# All of them are stored as raw numbers, i.e. seconds, bytes and counts.
+METRIC_COLUMNS = [
+    "benchmark_ret_code", "test_ret_code", "cpu_time_user", "cpu_time_system",
+    "mem_info_rss", "mem_info_vms", "avg_client_time", "avg_server_time",
+    "net_bytes_recv", "net_bytes_sent", "net_packets_recv",
+    "net_packets_sent", "net_bytes_per_msg", "net_bytes_per_client",
+    "max_established_conns", "conn_churn", "duration"
+]
+
+# Columns identifying a run and the cell of the benchmark it belongs to.
+KEY_COLUMNS = [
+    "id", "benchmark_id", "machine", "server_version", "server_git_hash",
+    "num_conns", "is_reliable", "timeout"
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    benchmark_id INTEGER NOT NULL,
+    machine TEXT,
+    server_version TEXT,
+    server_git_hash TEXT,
+    num_conns INTEGER,
+    is_reliable INTEGER,
+    timeout INTEGER,
+    {metrics}
+);
+CREATE TABLE IF NOT EXISTS messages (
+    run_id INTEGER NOT NULL,
+    target TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (run_id, target)
+);
+CREATE INDEX IF NOT EXISTS runs_benchmark_idx ON runs (benchmark_id);
+CREATE INDEX IF NOT EXISTS runs_build_idx
+    ON runs (server_version, server_git_hash);
+CREATE INDEX IF NOT EXISTS runs_cell_idx
+    ON runs (machine, num_conns, is_reliable, timeout);
+CREATE INDEX IF NOT EXISTS messages_target_idx ON messages (target);
+""".format(metrics=",\n    ".join("{} REAL".format(metric)
+                                  for metric in METRIC_COLUMNS))
+
+# Units used by run_benchmark.sizeof_fmt()
+SIZE_UNITS = ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi']
+
+RE_TIME = re.compile(r'^(-?\d+)m(-?\d+(?:\.\d*)?)s$')
+RE_SIZE = re.compile(r'^(-?\d+(?:\.\d*)?)\s*({})B$'.format(
+                     '|'.join(u for u in SIZE_UNITS if u)))
+RE_FILE = re.compile(r'benchmark_(\d+)_metrics\.csv$')
+
+
+def open_store(db_file):
+    """ Opens the SQLite results store, creating the tables and indices if
+    they do not exist yet. """
+    conn = sqlite3.connect(db_file)
+    conn.executescript(SCHEMA)
+
+    # add metric columns introduced after the store was created
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(runs)")}
+    for metric in METRIC_COLUMNS:
+        if metric not in existing:
+            conn.execute("ALTER TABLE runs ADD COLUMN {} REAL".format(metric))
+    conn.commit()
+
+    return conn
+
+
+def parse_value(value):
+    """ Converts a value of the metrics csv file back into a raw number.
+    Understands the human readable formats of run_benchmark.time_fmt() and
+    run_benchmark.sizeof_fmt(). Returns None for 'NA' and empty values. """
+    if value is None:
+        return None
+    value = value.strip()
+    if value in ('', 'NA'):
+        return None
+    if value in ('True', 'False'):
+        return int(value == 'True')
+
+    match = RE_TIME.match(value)
+    if match:
+        return int(match.group(1)) * 60 + float(match.group(2))
+
+    match = RE_SIZE.match(value)
+    if match:
+        return float(match.group(1)) * 1024 ** SIZE_UNITS.index(
+            match.group(2))
+
+    # plain bytes, e.g. '812.0B'
+    if value.endswith('B'):
+        value = value[:-1]
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def insert_run(conn, run, msg_counter=None):
+    """ Inserts a run into the store. `run` is a dictionary with keys from
+    KEY_COLUMNS and METRIC_COLUMNS holding raw values, missing keys are
+    stored as NULL. `msg_counter` maps message targets to their counts. An
+    already existing run with the same id is replaced. """
+    columns = KEY_COLUMNS + METRIC_COLUMNS
+    conn.execute("INSERT OR REPLACE INTO runs ({}) VALUES ({})".format(
+                 ", ".join(columns), ", ".join("?" * len(columns))),
+                 [run.get(c) for c in columns])
+
+    if msg_counter:
+        insert_messages(conn, run['id'], msg_counter)
+    conn.commit()
+
+
+def insert_messages(conn, run_id, msg_counter):
+    """ Inserts the message counts of a run into the store. """
+    conn.executemany("INSERT OR REPLACE INTO messages (run_id, target, count) "
+                     "VALUES (?, ?, ?)",
+                     [(run_id, target, int(count))
+                      for (target, count) in msg_counter.items()
+                      if target != 'id'])
+
+
+def import_csv(conn, metrics_file, server_version=None, server_git_hash=None):
+    """ Imports a metrics csv file written by run_benchmark.py together with
+    the messages csv file of the same benchmark, if it exists. Returns the
+    number of imported runs. """
+    match = RE_FILE.search(os.path.basename(metrics_file))
+    if not match:
+        raise ValueError("{} is not a benchmark metrics file.".format(
+                         metrics_file))
+    benchmark_id = int(match.group(1))
+
+    num_runs = 0
+    with open(metrics_file) as csv_metrics:
+        for row in csv.DictReader(csv_metrics):
+            run = {c: parse_value(row.get(c)) for c in METRIC_COLUMNS}
+            run.update({
+                'id': int(row['id']),
+                'benchmark_id': benchmark_id,
+                'machine': row.get('machine'),
+                'server_version': server_version,
+                'server_git_hash': server_git_hash,
+                'num_conns': parse_value(row.get('num_conns')),
+                'is_reliable': parse_value(row.get('is_reliable')),
+                'timeout': parse_value(row.get('timeout'))
+            })
+            insert_run(conn, run)
+            num_runs += 1
+
+    msg_file = metrics_file[:-len('metrics.csv')] + 'messages.csv'
+    if os.path.exists(msg_file):
+        with open(msg_file) as csv_msg:
+            for row in csv.DictReader(csv_msg):
+                run_id = int(row.pop('id'))
+                counts = {k: parse_value(v) for (k, v) in row.items()}
+                insert_messages(conn, run_id, {k: v for (k, v)
+                                               in counts.items()
+                                               if v is not None})
+        conn.commit()
+
+    return num_runs
+
+
+def query_history(conn, metric, machine=None, num_conns=None,
+                  is_reliable=None, timeout=None, server_git_hash=None,
+                  benchmark_id=None):
+    """ Returns the history of `metric` across all stored runs matching the
+    given filters, ordered by run id. `metric` is either a column of the runs
+    table or a message target like 'HI' or 'total'. Raises a ValueError if
+    `metric` is neither a metric column nor a target stored in the messages
+    table. """
+    if metric not in METRIC_COLUMNS and conn.execute(
+            "SELECT 1 FROM messages WHERE target = ? LIMIT 1",
+            (metric,)).fetchone() is None:
+        raise ValueError("Unknown metric {}, expected one of {} or a stored "
+                         "message target.".format(metric,
+                                                  ", ".join(METRIC_COLUMNS)))
+
+    filters = [('machine', machine), ('num_conns', num_conns),
+               ('is_reliable', is_reliable), ('timeout', timeout),
+               ('server_git_hash', server_git_hash),
+               ('benchmark_id', benchmark_id)]
+    where = ["runs.{} = ?".format(c) for (c, v) in filters if v is not None]
+    params = [v for (c, v) in filters if v is not None]
+
+    if metric in METRIC_COLUMNS:
+        value = "runs.{}".format(metric)
+        source = "runs"
+    else:
+        value = "messages.count"
+        source = "runs JOIN messages ON messages.run_id = runs.id"
+        where.insert(0, "messages.target = ?")
+        params.insert(0, metric)
+
+    sql = "SELECT {}, {} AS value FROM {}".format(
+          ", ".join("runs.{}".format(c) for c in KEY_COLUMNS), value, source)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY runs.id"
+
+    return conn.execute(sql, params)
+
+
+def get_cmd_args():
+    # Define ArgumentParser and declare all needed command line arguments
+    parser = argparse.ArgumentParser(description='Import benchmark csv files '
+                                     'into the results store and query the '
+                                     'history of a metric.')
+
+    parser.add_argument('-d', '--db', type=str, required=True,
+                        help='SQLite file of the results store.')
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    import_parser = subparsers.add_parser(
+        'import', help='Import metrics csv files and their corresponding '
+        'messages csv files.')
+    import_parser.add_argument('csv_files', type=str, nargs='+',
+                               help='Metrics csv files or directories '
+                               'containing them.')
+    import_parser.add_argument('--server_version', type=str,
+                               help='Server version to tag the imported runs '
+                               'with.')
+    import_parser.add_argument('--server_git_hash', type=str,
+                               help='Server git hash to tag the imported runs '
+                               'with.')
+
+    query_parser = subparsers.add_parser(
+        'query', help='Print the history of a metric as csv.')
+    query_parser.add_argument('metric', type=str,
+                              help='Metric column, e.g. cpu_time_user, or '
+                              'message target, e.g. total.')
+    query_parser.add_argument('-m', '--machine', type=str,
+                              help='Only consider runs on this machine.')
+    query_parser.add_argument('-n', '--num_conns', type=int,
+                              help='Only consider runs with this number of '
+                              'connections.')
+    query_parser.add_argument('-r', '--reliable', type=int, choices=[0, 1],
+                              help='Only consider runs with (1) or without '
+                              '(0) reliable messaging.')
+    query_parser.add_argument('-t', '--timeout', type=int,
+                              help='Only consider runs with this timeout.')
+    query_parser.add_argument('-g', '--server_git_hash', type=str,
+                              help='Only consider runs of this server build.')
+    query_parser.add_argument('-b', '--benchmark_id', type=int,
+                              help='Only consider runs of this benchmark.')
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_cmd_args()
+    conn = open_store(args.db)
+
+    if args.command == 'import':
+        metrics_files = []
+        for path in args.csv_files:
+            if os.path.isdir(path):
+                metrics_files += sorted(glob.glob(
+                    os.path.join(path, 'benchmark_*_metrics.csv')))
+            else:
+                metrics_files.append(path)
+
+        num_runs = 0
+        for metrics_file in metrics_files:
+            num_runs += import_csv(conn, metrics_file, args.server_version,
+                                   args.server_git_hash)
+        print("Imported {} runs from {} files.".format(num_runs,
+                                                       len(metrics_files)))
+        return
+
+    cursor = query_history(conn, args.metric, args.machine, args.num_conns,
+                           args.reliable, args.timeout, args.server_git_hash,
+                           args.benchmark_id)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(KEY_COLUMNS + [args.metric])
+    writer.writerows(cursor)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+        error = False
+    except (ValueError, sqlite3.Error, FileNotFoundError) as err:
+        error = err
+
+    if error:
+        print("Error: {}".format(error), file=sys.stderr)
+        sys.exit(1)
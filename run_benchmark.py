@@ -14,6 +14,9 @@ import configparser
 import argparse
 import collections
 
+import live_metrics
+import results_store
+
 try:
     import psutil
 except ImportError:
@@ -50,6 +53,11 @@ def get_cmd_args():
                         help='Timeouts to consider for the benchmark when '
                         'reliable messaging is used, can be a list.')
 
+    parser.add_argument('-p', '--metrics_port', type=int,
+                        help='Serve live metrics of the running benchmark in '
+                        'Prometheus format on '
+                        'http://localhost:<port>/metrics.')
+
     args = parser.parse_args()
 
     # Manually check dependency between command line arguments
@@ -157,6 +165,22 @@ def time_fmt(seconds):
     return "{:.0f}m{:.3f}s".format(seconds // 60, seconds % 60)
 
 
+# Cache of the last second formatted by iso_fmt(). Formatting the date is the
+# bottleneck when writing large message logs.
+ISO_FMT_CACHE = {'seconds': None, 'date': None}
+
+
+def iso_fmt(time_ms):
+    """ Utility function to format a Unix time in milliseconds like
+    JavaScript's Date.prototype.toISOString(). """
+    seconds, millis = divmod(int(time_ms), 1000)
+    if ISO_FMT_CACHE['seconds'] != seconds:
+        ISO_FMT_CACHE['seconds'] = seconds
+        ISO_FMT_CACHE['date'] = datetime.datetime.fromtimestamp(
+            seconds, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    return '{}.{:03d}Z'.format(ISO_FMT_CACHE['date'], millis)
+
+
 def build_nodegame(cfg):
     """ Routine to build nodegame, saves the build log into a separate file.
     Warns if there was an error. """
@@ -206,19 +230,85 @@ def run_launcher(cfg):
         return proc
 
 
-def get_process_metrics(proc):
+def get_net_io_counters(pid):
+    """ Reads the interface counters of the network namespace of the process
+    `pid` from /proc/<pid>/net/dev, `pid` may also be 'self'. Returns a
+    dictionary mapping every interface name to [bytes_recv, packets_recv,
+    bytes_sent, packets_sent]. Falls back to the system wide counters reported
+    by psutil on platforms without procfs. """
+    counters = {}
+    try:
+        with open('/proc/{}/net/dev'.format(pid)) as net_dev:
+            # the first two lines are headers
+            for line in list(net_dev)[2:]:
+                iface, data = line.split(':', 1)
+                fields = data.split()
+                counters[iface.strip()] = [int(fields[0]), int(fields[1]),
+                                           int(fields[8]), int(fields[9])]
+    except (OSError, ValueError, IndexError):
+        for iface, nic in psutil.net_io_counters(pernic=True).items():
+            counters[iface] = [nic.bytes_recv, nic.packets_recv,
+                               nic.bytes_sent, nic.packets_sent]
+    return counters
+
+
+def diff_net_io_counters(start, end):
+    """ Computes the per interface difference between two snapshots obtained
+    via get_net_io_counters(). Interfaces that vanished during the run are
+    ignored. """
+    return {iface: [e - s for (s, e) in zip(start.get(iface, [0] * 4), cnt)]
+            for (iface, cnt) in end.items()}
+
+
+def net_traffic_bytes(net_io):
+    """ Returns the number of bytes moved over all interfaces. Every byte sent
+    over the loopback interface is also received on it, hence only the
+    received bytes are counted there. """
+    total = 0
+    for iface, (b_recv, _, b_sent, _) in net_io.items():
+        total += b_recv if iface == 'lo' else b_recv + b_sent
+    return total
+
+
+def get_process_metrics(proc, live=None):
     """ Extracts CPU times, memory infos and connection infos about a given
-    process started via Popen(). Also obtains the return code. """
+    process started via Popen(). Also obtains the return code.
+
+    The network metrics consist of the interface counters sampled around the
+    run, the peak number of concurrently established connections on the
+    listening ports of the process, and the connection churn, i.e. the number
+    of connections opened or closed between two samples. Connections living
+    for less than the sampling interval of one second are not observed.
+
+    If `live` is a live_metrics.LiveMetrics instance, it is updated with every
+    sample. """
     p = psutil.Process(proc.pid)
     max_cpu = [0, 0]
     max_mem = [0, 0]
-    conns = []
+    net_start = get_net_io_counters(proc.pid)
+    net_end = net_start
+    max_established = 0
+    churn = 0
+    prev_conns = set()
 
     while proc.poll() is None:
         try:
             cpu = list(p.cpu_times())
             mem = list(p.memory_info())
-            conns = p.connections('all')
+            conns = p.connections('inet')
+            net_end = get_net_io_counters(proc.pid)
+
+            # only consider connections accepted on one of the ports the
+            # process is listening on, i.e. connections from clients
+            listen_ports = {c.laddr[1] for c in conns
+                            if c.status == psutil.CONN_LISTEN}
+            cur_conns = {(c.laddr, c.raddr) for c in conns
+                         if c.status == psutil.CONN_ESTABLISHED and c.raddr
+                         and c.laddr[1] in listen_ports}
+
+            max_established = max(max_established, len(cur_conns))
+            churn += len(cur_conns ^ prev_conns)
+            prev_conns = cur_conns
 
             for child in p.children(recursive=True):
                 c_cpu = list(child.cpu_times())
@@ -236,12 +326,59 @@ def get_process_metrics(proc):
             if max_mem[0] < mem[0]:
                 max_mem = mem
 
+            if live:
+                net_io = diff_net_io_counters(net_start, net_end)
+                live.set_process(
+                    cpu_user=cpu[0], cpu_system=cpu[1], mem_rss=mem[0],
+                    mem_vms=mem[1], established=len(cur_conns),
+                    net_bytes_recv=sum(cnt[0] for cnt in net_io.values()),
+                    net_bytes_sent=sum(cnt[2] for cnt in net_io.values()))
+
         except (psutil.AccessDenied, psutil.NoSuchProcess):
             pass
         time.sleep(1)
     retcode = proc.wait()
 
-    return retcode, max_cpu, max_mem, conns
+    # /proc/<pid> is gone once the process terminated, take the final sample
+    # from the namespace of the harness, which is the same one when the
+    # server runs locally. This includes the traffic of the last second, e.g.
+    # the disconnects of all clients.
+    net_end = get_net_io_counters('self')
+
+    net_io = diff_net_io_counters(net_start, net_end)
+    net = {
+        'bytes_recv': sum(cnt[0] for cnt in net_io.values()),
+        'packets_recv': sum(cnt[1] for cnt in net_io.values()),
+        'bytes_sent': sum(cnt[2] for cnt in net_io.values()),
+        'packets_sent': sum(cnt[3] for cnt in net_io.values()),
+        'traffic': net_traffic_bytes(net_io),
+        'max_established': max_established,
+        'churn': churn
+    }
+
+    return retcode, max_cpu, max_mem, net
+
+
+def get_server_version(cfg):
+    """ Returns the version of the nodegame server as found in its
+    package.json and the git hash of its checkout. Either value is None if it
+    cannot be determined. """
+    server_dir = cfg.get('Directories', 'server_dir')
+    try:
+        with open(os.path.join(server_dir, 'package.json')) as package_fp:
+            version = json.load(package_fp).get('version')
+    except (OSError, ValueError):
+        version = None
+
+    try:
+        git_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=server_dir,
+                                           stderr=subprocess.DEVNULL)
+        git_hash = git_hash.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_hash = None
+
+    return version, git_hash
 
 
 def run_test(cfg):
@@ -250,11 +387,11 @@ def run_test(cfg):
                            cwd=cfg.get('Directories', 'test_cwd'))
 
 
-def parse_server_msg_file(msg_file, is_reliable):
+def parse_server_msg_file(msg_file, is_reliable, offset=0):
     """ Parses the server message log file. Extract metrics about the total
     number of messages and the break down according to type. In addition
     computes the average delay of a message round-trip if reliable messaging is
-    enabled. """
+    enabled. Only the part of the file after byte `offset` is considered. """
 
     # define a message counter and a timestamps dictionary for both client and
     # server
@@ -263,6 +400,7 @@ def parse_server_msg_file(msg_file, is_reliable):
 
     # open the message file for reading
     with open(msg_file) as messages:
+        messages.seek(offset)
         for message in messages:
             # increment total message counter
             msg_counter['total'] += 1
@@ -371,12 +509,32 @@ def main():
                                'messages', 'csv')
 
     print('CSV files:\n{}\n{}\n'.format(csv_metrics_file, csv_msg_file))
+
+    # the results store keeps the raw values of all runs, the csv files are
+    # just an export of the current benchmark
+    results_db = cfg.get('Files', 'results_db', fallback=os.path.join(
+                         cfg.get('Directories', 'csv_dir'), 'results.db'))
+    print('Results store:\n{}\n'.format(results_db))
+
     # this defines the metrics we want to record
     metrics_names = [
         "id", "machine", "num_conns", "is_reliable", "timeout",
         "benchmark_ret_code", "test_ret_code", "cpu_time_user",
         "cpu_time_system", "mem_info_rss", "mem_info_vms",
-        "avg_client_time", "avg_server_time"
+        "avg_client_time", "avg_server_time", "net_bytes_recv",
+        "net_bytes_sent", "net_packets_recv", "net_packets_sent",
+        "net_bytes_per_msg", "net_bytes_per_client", "max_established_conns",
+        "conn_churn", "duration"
+    ]
+
+    # these metrics are written to the csv in human readable format
+    time_metrics = [
+        "cpu_time_user", "cpu_time_system", "avg_client_time",
+        "avg_server_time", "duration"
+    ]
+    size_metrics = [
+        "mem_info_rss", "mem_info_vms", "net_bytes_recv", "net_bytes_sent",
+        "net_bytes_per_msg", "net_bytes_per_client"
     ]
 
     # this defines the messages we want to record
@@ -422,6 +580,23 @@ def main():
             msg_writer.writerow(msg_counter)
             return
 
+        server_version, server_git_hash = get_server_version(cfg)
+        store = results_store.open_store(results_db)
+
+        # optionally serve live metrics while the benchmark is running
+        live = None
+        if args.metrics_port:
+            live = live_metrics.LiveMetrics()
+            try:
+                live_metrics.start_server(live, args.metrics_port)
+            except OSError as err:
+                print('Error: Could not serve live metrics on --metrics_port '
+                      '{}: {}'.format(args.metrics_port, err.strerror or err),
+                      file=sys.stderr)
+                sys.exit(1)
+            print('Live metrics:\nhttp://localhost:{}/metrics\n'.format(
+                  args.metrics_port))
+
         # iterate over the number of connections
         for num_conns in args.num_conns:
             # set the current number of connections in the cfg object and write
@@ -452,16 +627,30 @@ def main():
                 print("Number of Connections: {}, Reliable: {}, Timeout: {}"
                       .format(num_conns, bool(args.reliable), timeout))
 
+                # follow the message log to update the live metrics
+                if live:
+                    live.reset(reliable=bool(args.reliable),
+                               num_conns=num_conns,
+                               timeout=timeout if args.reliable else 'NA')
+                    tailer = live_metrics.MsgLogTailer(
+                        msg_file, live, cfg.get('General Settings', 'game'))
+                    tailer.start()
+
                 # start the launcher process
+                start_time = time.perf_counter()
                 launcher = run_launcher(cfg)
 
                 # if psutil is installed record operating system utils
                 if found_psutil:
-                    ret_benchmark, cpu, mem, conns = \
-                        get_process_metrics(launcher)
+                    ret_benchmark, cpu, mem, net = \
+                        get_process_metrics(launcher, live)
                 # else just wait for termination of the run
                 else:
                     ret_benchmark = launcher.wait()
+                duration = time.perf_counter() - start_time
+
+                if live:
+                    tailer.stop()
 
                 if ret_benchmark:
                     print("Warning: The current run had a non-zero exit code. "
@@ -483,30 +672,42 @@ def main():
                     msg_counter = \
                         parse_server_msg_file(msg_file, args.reliable)
 
-                # finally collect all benchmark metrics and write it to the csv
-                benchmark_metrics = {
+                # finally collect all raw benchmark metrics
+                run = {
                     'id': run_timestamp,
+                    'benchmark_id': BENCHMARK_TIME,
                     'machine': platform.platform(),
+                    'server_version': server_version,
+                    'server_git_hash': server_git_hash,
                     'num_conns': num_conns,
                     'is_reliable': bool(args.reliable),
-                    'timeout': timeout if args.reliable else 'NA',
+                    'timeout': timeout if args.reliable else None,
                     'benchmark_ret_code': ret_benchmark,
                     'test_ret_code': ret_test,
-                    'cpu_time_user':
-                        time_fmt(cpu[0]) if found_psutil else 'NA',
-                    'cpu_time_system':
-                        time_fmt(cpu[1]) if found_psutil else 'NA',
-                    'mem_info_rss':
-                        sizeof_fmt(mem[0]) if found_psutil else 'NA',
-                    'mem_info_vms':
-                        sizeof_fmt(mem[1]) if found_psutil else 'NA',
+                    'duration': duration,
                     'avg_client_time':
-                        time_fmt(avg_client_time) if args.reliable else 'NA',
+                        avg_client_time if args.reliable else None,
                     'avg_server_time':
-                        time_fmt(avg_server_time) if args.reliable else 'NA'
+                        avg_server_time if args.reliable else None
                 }
 
-                metrics_writer.writerow(benchmark_metrics)
+                if found_psutil:
+                    run.update({
+                        'cpu_time_user': cpu[0],
+                        'cpu_time_system': cpu[1],
+                        'mem_info_rss': mem[0],
+                        'mem_info_vms': mem[1],
+                        'net_bytes_recv': net['bytes_recv'],
+                        'net_bytes_sent': net['bytes_sent'],
+                        'net_packets_recv': net['packets_recv'],
+                        'net_packets_sent': net['packets_sent'],
+                        'net_bytes_per_msg':
+                            net['traffic'] / msg_counter['total']
+                            if msg_counter['total'] else None,
+                        'net_bytes_per_client': net['traffic'] / num_conns,
+                        'max_established_conns': net['max_established'],
+                        'conn_churn': net['churn']
+                    })
 
                 # add 'id' field to the message counter
                 msg_counter["id"] = run_timestamp
@@ -516,6 +717,23 @@ def main():
                     if msg_name not in msg_counter:
                         msg_counter[msg_name] = 0
 
+                results_store.insert_run(store, run, msg_counter)
+
+                # convert the metrics to human readable format and write them
+                # to the csv, missing values are reported as 'NA'
+                benchmark_metrics = {}
+                for name in metrics_names:
+                    value = run.get(name)
+                    if value is None:
+                        value = 'NA'
+                    elif name in time_metrics:
+                        value = time_fmt(value)
+                    elif name in size_metrics:
+                        value = sizeof_fmt(value)
+                    benchmark_metrics[name] = value
+
+                metrics_writer.writerow(benchmark_metrics)
+
                 # finally write the message statistics
                 msg_writer.writerow(msg_counter)
 
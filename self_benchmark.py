@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import json
+import math
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    found_resource = False
+else:
+    found_resource = True
+
+import gen_msg_log
+import run_benchmark
+
+# The analysis steps which are measured. Each of them is run in a separate
+# interpreter so that the peak memory usage of one does not hide the others.
+MODES = ['plain', 'reliable']
+
+RESULT_NAMES = [
+    "git_hash", "machine", "python", "mode", "lines", "clients", "ack_ratio",
+    "retransmit_ratio", "seconds", "lines_per_sec", "peak_mem",
+    "peak_mem_delta"
+]
+
+
+def get_max_rss():
+    """ Returns the peak resident set size of the current process in bytes or
+    0 if it is not available on this platform. """
+    if not found_resource:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def run_worker(mode, msg_file):
+    """ Parses `msg_file` with run_benchmark.parse_server_msg_file() and
+    prints the elapsed time, the peak memory of the interpreter and its
+    increase during the analysis as json. The increase is 0 if the analysis
+    never needs more memory than the imports before it. Meant to be executed
+    in a fresh interpreter via measure(). """
+    base_rss = get_max_rss()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        start = time.perf_counter()
+        run_benchmark.parse_server_msg_file(msg_file, mode == 'reliable')
+        seconds = time.perf_counter() - start
+
+    print(json.dumps({'seconds': seconds,
+                      'peak_mem': get_max_rss(),
+                      'peak_mem_delta': get_max_rss() - base_rss}))
+
+
+def measure(mode, msg_file, repeats):
+    """ Runs the analysis `repeats` times on `msg_file`, each time in a new
+    interpreter. Returns the fastest time, the largest peak memory and the
+    largest increase of the peak memory during the analysis. """
+    times = []
+    peak_mem = 0
+    peak_mem_delta = 0
+    for _ in range(repeats):
+        worker = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                 '--worker', mode, msg_file],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        if worker.returncode:
+            raise RuntimeError("The analysis of {} failed:\n{}".format(
+                               msg_file, worker.stderr))
+
+        result = json.loads(worker.stdout.splitlines()[-1])
+        times.append(result['seconds'])
+        peak_mem = max(peak_mem, result['peak_mem'])
+        peak_mem_delta = max(peak_mem_delta, result['peak_mem_delta'])
+
+    return min(times), peak_mem, peak_mem_delta
+
+
+def get_msg_file(data_dir, lines, clients, ack_ratio, retransmit_ratio):
+    """ Returns a synthetic message log with the given parameters, generating
+    it only if it does not exist in `data_dir` yet. """
+    msg_file = os.path.join(data_dir, 'messages_{}_{}_{}_{}.log'.format(
+                            lines, clients, ack_ratio, retransmit_ratio))
+    if not os.path.exists(msg_file):
+        print("Generating {}".format(msg_file))
+        # write to a temporary file first so that an interrupted generation
+        # does not leave a truncated log behind
+        with open(msg_file + '.tmp', 'w') as msg_fp:
+            gen_msg_log.generate_msg_log(msg_fp, lines, clients,
+                                         ack_ratio=ack_ratio,
+                                         retransmit_ratio=retransmit_ratio)
+        os.rename(msg_file + '.tmp', msg_file)
+
+    return msg_file
+
+
+def scaling_exponent(lines, seconds):
+    """ Least squares fit of log(seconds) = k * log(lines) + c. Returns k,
+    which is close to 1 if the analysis scales linearly with the input. """
+    xs = [math.log(x) for x in lines]
+    ys = [math.log(y) for y in seconds]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    var = sum((x - x_mean) ** 2 for x in xs)
+    if not var:
+        return float('nan')
+    return sum((x - x_mean) * (y - y_mean) for (x, y) in zip(xs, ys)) / var
+
+
+def get_git_hash():
+    """ Returns the git hash of the benchmark harness itself, so that results
+    can be compared across commits. """
+    try:
+        git_hash = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return 'NA'
+    return git_hash.decode().strip()
+
+
+def get_cmd_args():
+    # Define ArgumentParser and declare all needed command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark the analysis of '
+                                     'run_benchmark.py on synthetic message '
+                                     'logs.')
+
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[10**4, 10**5, 10**6],
+                        help='Number of lines of the message logs to '
+                        'analyze, can be a list.')
+
+    parser.add_argument('-c', '--clients', type=int, default=100,
+                        help='Number of clients in the message logs.')
+
+    parser.add_argument('-a', '--ack_ratio', type=float, default=0.5,
+                        help='Fraction of acknowledged messages.')
+
+    parser.add_argument('-rt', '--retransmit_ratio', type=float, default=0.01,
+                        help='Fraction of retransmitted messages.')
+
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='Number of repetitions per measurement, the '
+                        'fastest one is reported.')
+
+    parser.add_argument('-d', '--data_dir', type=str,
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'nodegame-self-benchmark'),
+                        help='Folder where the generated message logs are '
+                        'kept between invocations.')
+
+    parser.add_argument('-o', '--output', type=str,
+                        help='Csv file the results are appended to.')
+
+    parser.add_argument('--worker', type=str, nargs=2,
+                        metavar=('MODE', 'MSG_FILE'), help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_cmd_args()
+
+    if args.worker:
+        run_worker(*args.worker)
+        return
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    common = {
+        'git_hash': get_git_hash(),
+        'machine': platform.platform(),
+        'python': platform.python_version(),
+        'clients': args.clients,
+        'ack_ratio': args.ack_ratio,
+        'retransmit_ratio': args.retransmit_ratio
+    }
+
+    results = []
+    for lines in sorted(args.sizes):
+        msg_file = get_msg_file(args.data_dir, lines, args.clients,
+                                args.ack_ratio, args.retransmit_ratio)
+        for mode in MODES:
+            seconds, peak_mem, peak_mem_delta = measure(mode, msg_file,
+                                                        args.repeats)
+            result = dict(common, mode=mode, lines=lines, seconds=seconds,
+                          lines_per_sec=lines / seconds, peak_mem=peak_mem,
+                          peak_mem_delta=peak_mem_delta)
+            results.append(result)
+            print("{:>8} {:>10} lines: {:>12} {:>12.0f} lines/s "
+                  "peak {:>10} (+{})".format(
+                      mode, lines, run_benchmark.time_fmt(seconds),
+                      result['lines_per_sec'],
+                      run_benchmark.sizeof_fmt(peak_mem),
+                      run_benchmark.sizeof_fmt(peak_mem_delta)))
+
+    if len(args.sizes) > 1:
+        for mode in MODES:
+            mode_results = [r for r in results if r['mode'] == mode]
+            exponent = scaling_exponent([r['lines'] for r in mode_results],
+                                        [r['seconds'] for r in mode_results])
+            print("Scaling exponent of {}: {:.2f}".format(mode, exponent))
+
+    if args.output:
+        write_header = not os.path.exists(args.output)
+        with open(args.output, 'a') as csv_out:
+            writer = csv.DictWriter(csv_out, fieldnames=RESULT_NAMES)
+            if write_header:
+                writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == '__main__':
+    main()